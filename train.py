@@ -24,12 +24,18 @@ equivalent: it takes as input a 3D volume or a sequence of 2D frames (e.g. slice
 
 import os
 import argparse
-import zipfile
+import glob
+import hashlib
+import math
+import multiprocessing
+import random
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import tensorflow as tf
 
 from tensorflow import keras
 from tensorflow.keras import layers
+from tensorflow.keras import mixed_precision
 
 
 """
@@ -51,51 +57,52 @@ will be used when building training and validation datasets.
 
 import nibabel as nib
 
-from scipy import ndimage
+# Preprocessing parameters. They are also part of the key of the preprocessed scan
+# cache, so changing any of them invalidates cached scans.
+SCAN_WIDTH = 128
+SCAN_HEIGHT = 128
+SCAN_DEPTH = 64
+HU_MIN = -1000.0
+HU_MAX = 400.0
+RESIZE_METHOD = "bilinear"
+SCAN_DTYPE = "uint8"
 
 
 def read_nifti_file(filepath):
     """Read and load volume"""
-    # Read file
-    scan = nib.load(filepath)
-    # Get raw data
-    scan = scan.get_fdata()
+    # Read file, memory-mapping the voxel data where possible
+    scan = nib.load(filepath, mmap=True)
+    # Get raw data as float32 rather than the float64 that get_fdata() returns
+    scan = np.asarray(scan.dataobj, dtype=np.float32)
     return scan
 
 
 def normalize(volume):
     """Normalize the volume"""
-    min = -1000
-    max = 400
-    volume[volume < min] = min
-    volume[volume > max] = max
-    volume = (volume - min) / (max - min)
-    volume = volume.astype("float32")
+    min = HU_MIN
+    max = HU_MAX
+    volume = volume.astype("float32", copy=False)
+    np.clip(volume, min, max, out=volume)
+    volume -= min
+    volume *= 1.0 / (max - min)
     return volume
 
 
 def resize_volume(img):
     """Resize across z-axis"""
     # Set the desired depth
-    desired_depth = 64
-    desired_width = 128
-    desired_height = 128
-    # Get current depth
-    current_depth = img.shape[-1]
-    current_width = img.shape[0]
-    current_height = img.shape[1]
-    # Compute depth factor
-    depth = current_depth / desired_depth
-    width = current_width / desired_width
-    height = current_height / desired_height
-    depth_factor = 1 / depth
-    width_factor = 1 / width
-    height_factor = 1 / height
-    # Rotate
-    img = ndimage.rotate(img, 90, reshape=False)
-    # Resize across z-axis
-    img = ndimage.zoom(img, (width_factor, height_factor, depth_factor), order=1)
-    return img
+    desired_depth = SCAN_DEPTH
+    desired_width = SCAN_WIDTH
+    desired_height = SCAN_HEIGHT
+    # Rotate by exactly 90 degrees, which only reorders the voxels
+    img = np.rot90(img, k=1, axes=(0, 1))
+    # Resize width and height, treating each depth slice as a channel
+    img = tf.image.resize(img, [desired_width, desired_height], method=RESIZE_METHOD)
+    # Resize across z-axis, treating each row as a channel
+    img = tf.transpose(img, perm=[0, 2, 1])
+    img = tf.image.resize(img, [desired_width, desired_depth], method=RESIZE_METHOD)
+    img = tf.transpose(img, perm=[0, 2, 1])
+    return img.numpy()
 
 
 def process_scan(path):
@@ -106,9 +113,101 @@ def process_scan(path):
     volume = normalize(volume)
     # Resize width, height and depth
     volume = resize_volume(volume)
+    # Quantize to 8 bits, a quarter of the memory of float32
+    volume = np.round(volume * 255.0).astype(SCAN_DTYPE)
     return volume
 
 
+def init_preprocessing_worker():
+    """Keep preprocessing workers off the GPU so they don't compete with training"""
+    tf.config.set_visible_devices([], "GPU")
+    # The workers already run side by side, so each one runs TensorFlow ops on a
+    # single thread instead of starting thread pools the size of the machine.
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+# Each spawned worker re-imports this script and therefore TensorFlow, which costs
+# about 550 MB of RSS and a few seconds of startup per worker, so the pool is capped.
+MAX_PREPROCESSING_WORKERS = 8
+PREPROCESSING_CHUNKSIZE = 4
+
+
+def preprocessing_pool(num_scans):
+    """Create a process pool sized for preprocessing `num_scans` scans"""
+    # Scans are independent of each other, so spread them across the cores.
+    # Workers are spawned rather than forked: by now the parent process is
+    # multithreaded and has initialized TensorFlow and CUDA, which a forked child
+    # cannot safely inherit. They are only started once work is submitted, so a
+    # run that hits the cache never pays for them.
+    max_workers = min(
+        os.cpu_count(),
+        math.ceil(num_scans / PREPROCESSING_CHUNKSIZE),
+        MAX_PREPROCESSING_WORKERS,
+    )
+    return ProcessPoolExecutor(
+        max_workers=max(max_workers, 1),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_preprocessing_worker,
+    )
+
+
+def cache_key(paths):
+    """Hash the scans and the preprocessing parameters into a cache key"""
+    params = [SCAN_WIDTH, SCAN_HEIGHT, SCAN_DEPTH, HU_MIN, HU_MAX, RESIZE_METHOD, SCAN_DTYPE]
+    return hashlib.md5(repr(sorted(paths) + params).encode()).hexdigest()
+
+
+def load_scans(paths, cache_dir, executor):
+    """Process a list of scans, reusing a cached copy from a previous run if present"""
+    # Process the scans in sorted order, so a fresh run and a cache hit return the
+    # scans in the same order.
+    paths = sorted(paths)
+    cache_file = os.path.join(cache_dir, f"cache_{cache_key(paths)}.npy")
+    if os.path.exists(cache_file):
+        return np.load(cache_file, mmap_mode="r")
+    # Write each scan straight into a preallocated array rather than holding
+    # them all in a list before copying them together.
+    scans = np.empty(
+        (len(paths), SCAN_WIDTH, SCAN_HEIGHT, SCAN_DEPTH), dtype=SCAN_DTYPE
+    )
+    results = executor.map(process_scan, paths, chunksize=PREPROCESSING_CHUNKSIZE)
+    for i, scan in enumerate(results):
+        scans[i] = scan
+    # Write to a temporary file first so an interrupted run never leaves a
+    # truncated cache behind.
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.save(f, scans)
+    os.replace(tmp_file, cache_file)
+    return scans
+
+
+def stream_scans(pairs, cache_dir):
+    """Build a dataset that processes (path, label) pairs as they are consumed"""
+
+    def load(path, label):
+        volume = tf.py_function(
+            lambda path: process_scan(path.numpy().decode()),
+            [path],
+            tf.as_dtype(SCAN_DTYPE),
+        )
+        return tf.ensure_shape(volume, (SCAN_WIDTH, SCAN_HEIGHT, SCAN_DEPTH)), label
+
+    paths = [path for path, _ in pairs]
+    labels = [label for _, label in pairs]
+    # Decode several scans at once; the order is kept, so the cache is deterministic.
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels)).map(
+        load, num_parallel_calls=tf.data.AUTOTUNE
+    )
+    # After the first full pass the processed scans are read back from disk. A run
+    # killed during that pass leaves a lockfile behind that would make the next run
+    # fail with AlreadyExistsError, so remove it. Don't stream two runs into the same
+    # data_dir at once.
+    cache_file = os.path.join(cache_dir, f"cache_{cache_key(paths)}")
+    for lockfile in glob.glob(f"{cache_file}*.lockfile"):
+        os.remove(lockfile)
+    return dataset.cache(cache_file)
 
 
 """
@@ -121,32 +220,36 @@ different kinds of preprocessing and augmentation techniques out there,
 this example shows a few simple ones to get started.
 """
 
-import random
-
-from scipy import ndimage
-
 
 @tf.function
 def rotate(volume):
     """Rotate the volume by a few degrees"""
-
-    def scipy_rotate(volume):
-        # define some rotation angles
-        angles = [-20, -10, -5, 5, 10, 20]
-        # pick angles at random
-        angle = random.choice(angles)
-        # rotate volume
-        volume = ndimage.rotate(volume, angle, reshape=False)
-        volume[volume < 0] = 0
-        volume[volume > 1] = 1
-        return volume
-
-    augmented_volume = tf.numpy_function(scipy_rotate, [volume], tf.float32)
-    return augmented_volume
+    # pick an angle between -20 and 20 degrees at random
+    angle = tf.random.uniform([], -20.0, 20.0) * math.pi / 180
+    # rotate volume in the height-width plane about its center, treating the
+    # depth slices as channels of a single image
+    height = tf.cast(tf.shape(volume)[0], tf.float32)
+    width = tf.cast(tf.shape(volume)[1], tf.float32)
+    cos = tf.cos(angle)
+    sin = tf.sin(angle)
+    x_offset = ((width - 1) - (cos * (width - 1) - sin * (height - 1))) / 2
+    y_offset = ((height - 1) - (sin * (width - 1) + cos * (height - 1))) / 2
+    transform = tf.stack([cos, -sin, x_offset, sin, cos, y_offset, 0.0, 0.0])
+    volume = tf.raw_ops.ImageProjectiveTransformV3(
+        images=volume[tf.newaxis],
+        transforms=transform[tf.newaxis],
+        output_shape=tf.shape(volume)[:2],
+        fill_value=0.0,
+        interpolation="BILINEAR",
+        fill_mode="CONSTANT",
+    )[0]
+    return tf.clip_by_value(volume, 0.0, 1.0)
 
 
 def train_preprocessing(volume, label):
-    """Process training data by rotating and adding a channel."""
+    """Process training data by rescaling, rotating and adding a channel."""
+    # Rescale to the range 0 to 1
+    volume = tf.cast(volume, tf.float32) * (1.0 / 255.0)
     # Rotate volume
     volume = rotate(volume)
     volume = tf.expand_dims(volume, axis=3)
@@ -154,7 +257,8 @@ def train_preprocessing(volume, label):
 
 
 def validation_preprocessing(volume, label):
-    """Process validation data by only adding a channel."""
+    """Process validation data by only rescaling and adding a channel."""
+    volume = tf.cast(volume, tf.float32) * (1.0 / 255.0)
     volume = tf.expand_dims(volume, axis=3)
     return volume, label
 
@@ -166,37 +270,77 @@ is based on [this paper](https://arxiv.org/abs/2007.13224).
 """
 
 
-def get_model(width=128, height=128, depth=64):
+def get_model(width=128, height=128, depth=64, batch_norm=True):
     """Build a 3D convolutional neural network model."""
 
     inputs = keras.Input((width, height, depth, 1))
 
     x = layers.Conv3D(filters=64, kernel_size=3, activation="relu")(inputs)
     x = layers.MaxPool3D(pool_size=2)(x)
-    x = layers.BatchNormalization()(x)
+    if batch_norm:
+        x = layers.BatchNormalization()(x)
 
     x = layers.Conv3D(filters=64, kernel_size=3, activation="relu")(x)
     x = layers.MaxPool3D(pool_size=2)(x)
-    x = layers.BatchNormalization()(x)
+    if batch_norm:
+        x = layers.BatchNormalization()(x)
 
     x = layers.Conv3D(filters=128, kernel_size=3, activation="relu")(x)
     x = layers.MaxPool3D(pool_size=2)(x)
-    x = layers.BatchNormalization()(x)
+    if batch_norm:
+        x = layers.BatchNormalization()(x)
 
     x = layers.Conv3D(filters=256, kernel_size=3, activation="relu")(x)
     x = layers.MaxPool3D(pool_size=2)(x)
-    x = layers.BatchNormalization()(x)
+    if batch_norm:
+        x = layers.BatchNormalization()(x)
 
     x = layers.GlobalAveragePooling3D()(x)
     x = layers.Dense(units=512, activation="relu")(x)
     x = layers.Dropout(0.3)(x)
 
-    outputs = layers.Dense(units=1, activation="sigmoid")(x)
+    # Keep the sigmoid in float32 so the loss stays numerically stable under
+    # mixed precision.
+    x = layers.Dense(units=1)(x)
+    outputs = layers.Activation("sigmoid", dtype="float32")(x)
 
     # Define the model.
     model = keras.Model(inputs, outputs, name="3dcnn")
     return model
 
+
+"""
+At inference time each `BatchNormalization` is a constant per-channel affine rescale.
+It follows the ReLU and max pooling of its block, so it cannot be folded into the
+Conv3D before it, but it can be folded exactly into the layer that consumes it: the
+next Conv3D (which uses valid padding), or the first Dense layer for the last block
+(global average pooling is linear). This removes a full pass over the activations
+per block.
+"""
+
+
+def fold_batch_norm(model, width=128, height=128, depth=64):
+    """Build an inference copy of the model with batch normalization folded away."""
+    folded = get_model(width=width, height=height, depth=depth, batch_norm=False)
+    weighted = (layers.Conv3D, layers.Dense)
+    targets = [layer for layer in folded.layers if isinstance(layer, weighted)]
+
+    scale = shift = None
+    for layer in model.layers:
+        if isinstance(layer, layers.BatchNormalization):
+            gamma, beta, mean, variance = layer.get_weights()
+            scale = gamma / np.sqrt(variance + layer.epsilon)
+            shift = beta - mean * scale
+        elif isinstance(layer, weighted):
+            kernel, bias = layer.get_weights()
+            if scale is not None:
+                # The input channels are the second to last axis of the kernel.
+                bias = bias + shift @ kernel.reshape(-1, *kernel.shape[-2:]).sum(axis=0)
+                kernel = kernel * scale[:, None]
+                scale = shift = None
+            targets.pop(0).set_weights([kernel, bias])
+    return folded
+
 def download_data():
         """
         ## Downloading the MosMedData: Chest CT Scans with COVID-19 Related Findings
@@ -231,21 +375,33 @@ def download_data():
         os.makedirs(mos_med_data, exist_ok=True)
 
         # # Download url of normal CT scans.
+        # The archive is extracted into the newly created directory. Depending on the
+        # Keras version this is either `MosMedData/` itself or a `CT-0_extracted/`
+        # directory under it, so the scans are later found with `find_scan_dir`.
         url = "https://github.com/hasibzunair/3D-image-classification-tutorial/releases/download/v0.2/CT-0.zip"
-        ct0_zip = os.path.join(args.data_dir, "CT-0.zip")
-        keras.utils.get_file(ct0_zip, url)
+        keras.utils.get_file(
+            "CT-0.zip", url, extract=True, cache_dir=args.data_dir, cache_subdir="MosMedData"
+        )
 
         # Download url of abnormal CT scans.
         url = "https://github.com/hasibzunair/3D-image-classification-tutorial/releases/download/v0.2/CT-23.zip"
-        ct23_zip = os.path.join(args.data_dir, "CT-23.zip")
-        keras.utils.get_file(ct23_zip, url)
+        keras.utils.get_file(
+            "CT-23.zip", url, extract=True, cache_dir=args.data_dir, cache_subdir="MosMedData"
+        )
+
 
-        # Unzip data in the newly created directory.
-        with zipfile.ZipFile(ct0_zip, "r") as z_fp:
-            z_fp.extractall(mos_med_data)
+def find_scan_dir(root, name):
+    """Find the directory `name` that a scan archive was extracted to under `root`"""
+    for base, dirs, _ in os.walk(root):
+        if name in dirs:
+            return os.path.join(base, name)
+    # Keras 3 extracts an archive without a top-level directory straight into
+    # `<name>_extracted`.
+    extracted = os.path.join(root, f"{name}_extracted")
+    if os.path.isdir(extracted):
+        return extracted
+    raise FileNotFoundError(f"No {name} directory found under {root}")
 
-        with zipfile.ZipFile(ct23_zip, "r") as z_fp:
-            z_fp.extractall(mos_med_data)
 
 if __name__ == '__main__':
 
@@ -254,9 +410,30 @@ if __name__ == '__main__':
     parser.add_argument('--download', type=bool, default=True)
     parser.add_argument('--max_epochs', type=int, default=100)
     parser.add_argument('--learning_rate', type=float, default=1e-3)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--stream', action='store_true')
     parser.add_argument('--gpus', type=int, default=0)
+    parser.add_argument('--mixed_precision', action=argparse.BooleanOptionalAction, default=True)
     args = parser.parse_args()
 
+    # Allow TF32 tensor cores for the Conv3D layers on Ampere and newer GPUs. This is
+    # the default since TF 2.5, but set it explicitly before the GPU is initialized.
+    # NVIDIA_TF32_OVERRIDE=0 still wins if exported, e.g. to debug precision issues.
+    os.environ.setdefault("NVIDIA_TF32_OVERRIDE", "1")
+    tf.config.experimental.enable_tensor_float_32_execution(True)
+
+    # The model expects NDHWC inputs, which is also the layout cuDNN prefers for
+    # Conv3D on tensor cores.
+    keras.backend.set_image_data_format("channels_last")
+
+    # Compute in float16 while keeping the weights in float32. This only pays off on
+    # GPUs, and some float16 ops such as MaxPool3D have no CPU kernel.
+    use_mixed_precision = args.mixed_precision and bool(
+        tf.config.list_physical_devices("GPU")
+    )
+    if use_mixed_precision:
+      mixed_precision.set_global_policy("mixed_float16")
+
     if args.download:
       download_data()
 
@@ -271,14 +448,18 @@ if __name__ == '__main__':
     # Folder "CT-0" consist of CT scans having normal lung tissue,
     # no CT-signs of viral pneumonia.
     normal_scan_paths = [
-        os.path.join(args.data_dir, "MosMedData/CT-0", x)
-        for x in os.listdir(os.path.join(args.data_dir,"MosMedData/CT-0"))
+        entry.path
+        for entry in os.scandir(
+            find_scan_dir(os.path.join(args.data_dir, "MosMedData"), "CT-0")
+        )
     ]
     # Folder "CT-23" consist of CT scans having several ground-glass opacifications,
     # involvement of lung parenchyma.
     abnormal_scan_paths = [
-        os.path.join(args.data_dir, "MosMedData/CT-23", x)
-        for x in os.listdir(os.path.join(args.data_dir,"MosMedData/CT-23"))
+        entry.path
+        for entry in os.scandir(
+            find_scan_dir(os.path.join(args.data_dir, "MosMedData"), "CT-23")
+        )
     ]
 
     print("CT scans with normal lung tissue: " + str(len(normal_scan_paths)))
@@ -292,50 +473,86 @@ if __name__ == '__main__':
     Lastly, split the dataset into train and validation subsets.
     """
 
-    # Read and process the scans.
-    # Each scan is resized across height, width, and depth and rescaled.
-    abnormal_scans = np.array([process_scan(path) for path in abnormal_scan_paths])
-    normal_scans = np.array([process_scan(path) for path in normal_scan_paths])
-
-    # For the CT scans having presence of viral pneumonia
-    # assign 1, for the normal ones assign 0.
-    abnormal_labels = np.array([1 for _ in range(len(abnormal_scans))])
-    normal_labels = np.array([0 for _ in range(len(normal_scans))])
-
-    # Split data in the ratio 70-30 for training and validation.
-    x_train = np.concatenate((abnormal_scans[:70], normal_scans[:70]), axis=0)
-    y_train = np.concatenate((abnormal_labels[:70], normal_labels[:70]), axis=0)
-    x_val = np.concatenate((abnormal_scans[70:], normal_scans[70:]), axis=0)
-    y_val = np.concatenate((abnormal_labels[70:], normal_labels[70:]), axis=0)
+    if args.stream:
+      # Process the scans lazily while the first epoch runs instead of holding them
+      # all in memory, which does not scale to the full dataset. For the CT scans
+      # having presence of viral pneumonia assign 1, for the normal ones assign 0,
+      # and split the data in the ratio 70-30 for training and validation.
+      abnormal_scan_paths = sorted(abnormal_scan_paths)
+      normal_scan_paths = sorted(normal_scan_paths)
+      train_pairs = [(path, 1) for path in abnormal_scan_paths[:70]] + [
+          (path, 0) for path in normal_scan_paths[:70]
+      ]
+      val_pairs = [(path, 1) for path in abnormal_scan_paths[70:]] + [
+          (path, 0) for path in normal_scan_paths[70:]
+      ]
+      # Mix the classes up front, since the shuffle buffer below only holds a few
+      # scans.
+      random.shuffle(train_pairs)
+      random.shuffle(val_pairs)
+      train_loader = stream_scans(train_pairs, args.data_dir)
+      validation_loader = stream_scans(val_pairs, args.data_dir)
+      num_train = len(train_pairs)
+      num_val = len(val_pairs)
+      # A full-size shuffle buffer would have to hold every scan before the first
+      # step, so keep it to a few batches.
+      shuffle_buffer = 4 * args.batch_size
+    else:
+      # Read and process the scans.
+      # Each scan is resized across height, width, and depth and rescaled.
+      # The processed scans are cached under `data_dir` so later runs skip this step.
+      # Both classes share one pool, so its workers are only started once.
+      num_scans = len(abnormal_scan_paths) + len(normal_scan_paths)
+      with preprocessing_pool(num_scans) as executor:
+        abnormal_scans = load_scans(abnormal_scan_paths, args.data_dir, executor)
+        normal_scans = load_scans(normal_scan_paths, args.data_dir, executor)
+
+      # For the CT scans having presence of viral pneumonia
+      # assign 1, for the normal ones assign 0.
+      abnormal_labels = np.array([1 for _ in range(len(abnormal_scans))])
+      normal_labels = np.array([0 for _ in range(len(normal_scans))])
+
+      # Split data in the ratio 70-30 for training and validation.
+      x_train = np.concatenate((abnormal_scans[:70], normal_scans[:70]), axis=0)
+      y_train = np.concatenate((abnormal_labels[:70], normal_labels[:70]), axis=0)
+      x_val = np.concatenate((abnormal_scans[70:], normal_scans[70:]), axis=0)
+      y_val = np.concatenate((abnormal_labels[70:], normal_labels[70:]), axis=0)
+
+      # Define data loaders.
+      train_loader = tf.data.Dataset.from_tensor_slices((x_train, y_train))
+      validation_loader = tf.data.Dataset.from_tensor_slices((x_val, y_val))
+      num_train = len(x_train)
+      num_val = len(x_val)
+      shuffle_buffer = max(num_train, num_val)
+
     print(
         "Number of samples in train and validation are %d and %d."
-        % (x_train.shape[0], x_val.shape[0])
+        % (num_train, num_val)
     )
 
     """
     While defining the train and validation data loader, the training data is passed through
     and augmentation function which randomly rotates volume at different angles. Note that both
-    training and validation data are already rescaled to have values between 0 and 1.
+    training and validation data are already rescaled, and are stored as 8-bit integers
+    that are only converted back to floats between 0 and 1 inside the data loaders.
     """
 
-    # Define data loaders.
-    train_loader = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    validation_loader = tf.data.Dataset.from_tensor_slices((x_val, y_val))
-
-    batch_size = 2
+    batch_size = args.batch_size
     # Augment the on the fly during training.
     train_dataset = (
-        train_loader.shuffle(len(x_train))
-        .map(train_preprocessing)
-        .batch(batch_size)
-        .prefetch(2)
+        train_loader.shuffle(shuffle_buffer)
+        .map(train_preprocessing, num_parallel_calls=tf.data.AUTOTUNE)
+        # Drop the last partial batch so every training step has the same shape
+        # and the step is traced and compiled only once.
+        .batch(batch_size, drop_remainder=True)
+        .prefetch(tf.data.AUTOTUNE)
     )
     # Only rescale.
     validation_dataset = (
-        validation_loader.shuffle(len(x_val))
-        .map(validation_preprocessing)
+        validation_loader.shuffle(shuffle_buffer)
+        .map(validation_preprocessing, num_parallel_calls=tf.data.AUTOTUNE)
         .batch(batch_size)
-        .prefetch(2)
+        .prefetch(tf.data.AUTOTUNE)
     )
     """
     ## Train model
@@ -350,15 +567,26 @@ if __name__ == '__main__':
     lr_schedule = keras.optimizers.schedules.ExponentialDecay(
         initial_learning_rate, decay_steps=100000, decay_rate=0.96, staircase=True
     )
+    optimizer = keras.optimizers.Adam(learning_rate=lr_schedule)
+    if use_mixed_precision:
+      # Scale the loss so small float16 gradients don't underflow.
+      optimizer = mixed_precision.LossScaleOptimizer(optimizer)
     model.compile(
         loss="binary_crossentropy",
-        optimizer=keras.optimizers.Adam(learning_rate=lr_schedule),
+        optimizer=optimizer,
         metrics=["acc"],
+        # The input shape is fixed, so let XLA fuse the Conv3D/ReLU/BatchNorm blocks.
+        jit_compile=True,
     )
 
     # Define callbacks.
+    # Only the weights are checkpointed, so that a new best epoch doesn't stall
+    # training while the whole model is serialized. Keras 3 requires weights-only
+    # checkpoints to end in `.weights.h5`, which Keras 2 also saves as HDF5.
+    os.makedirs("checkpoints", exist_ok=True)
+    checkpoint_path = os.path.join("checkpoints", "3d_image_classification.weights.h5")
     checkpoint_cb = keras.callbacks.ModelCheckpoint(
-        "3d_image_classification.h5", save_best_only=True
+        checkpoint_path, monitor="val_acc", save_best_only=True, save_weights_only=True
     )
     early_stopping_cb = keras.callbacks.EarlyStopping(monitor="val_acc", patience=15)
     tb_callback = tf.keras.callbacks.TensorBoard(log_dir='./lightning_logs/keras')
@@ -387,8 +615,19 @@ if __name__ == '__main__':
     """
 
     # Load best weights.
-    model.load_weights("3d_image_classification.h5")
-    prediction = model.predict(np.expand_dims(x_val[0], axis=0))[0]
+    model.load_weights(checkpoint_path)
+    inference_model = fold_batch_norm(model, width=128, height=128, depth=64)
+
+    # Compile the forward pass once for a single scan.
+    @tf.function(
+        input_signature=[tf.TensorSpec(shape=(1, 128, 128, 64, 1), dtype=tf.float32)],
+        jit_compile=True,
+    )
+    def predict(volume):
+        return inference_model(volume, training=False)
+
+    volume, _ = validation_preprocessing(*next(iter(validation_loader)))
+    prediction = predict(volume[tf.newaxis]).numpy()[0]
     scores = [1 - prediction[0], prediction[0]]
 
     class_names = ["normal", "abnormal"]